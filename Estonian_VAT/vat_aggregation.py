@@ -0,0 +1,155 @@
+# Aggregate transaction level VAT declaration exports into the monthly VAT series used by vat_comparison.py.
+# Input files are split into byte ranges that are memory-mapped and aggregated in a process pool,
+# so memory use is bounded regardless of input size.
+import argparse
+import collections
+import concurrent.futures
+import csv
+import io
+import mmap
+import os
+from typing import BinaryIO, Iterator
+
+# Settings
+date_field = "period"                   # Date of the declaration: YYYY-MM or YYYY-MM-DD
+amount_field = "vat_eur"
+encoding = "utf8"
+range_size_bytes = 256 * 2**20          # Size of the byte ranges that are aggregated by a single worker task
+block_size_bytes = 8 * 2**20            # Size of the blocks that are decoded and parsed at a time
+
+# Output
+vat_data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vat_monthly.csv")
+
+
+##########
+# Worker #
+##########
+
+def iter_line_blocks(data_file: BinaryIO, start: int, end: int, block_size: int) -> Iterator[bytes]:
+    """
+    Yields blocks of whole lines that start within the byte range [start, end) of the memory-mapped file.
+    """
+    with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+
+        def get_line_end(position: int) -> int:
+            """
+            Returns the end position of the line that contains the byte at position.
+            """
+            newline = data.find(b"\n", position)
+            return size if newline == -1 else newline + 1
+
+        # The range starts from the first line that starts within it and stops after the last line that starts within it
+        position = 0 if start == 0 else get_line_end(start - 1)
+        stop = size if end >= size else get_line_end(end - 1)
+        while position < stop:
+            block_end = min(position + block_size, stop)
+            if block_end < stop:
+                block_end = get_line_end(block_end - 1)
+            yield data[position:block_end]
+            position = block_end
+
+
+def aggregate_range(path: str, start: int, end: int, i_date: int, i_amount: int, block_size: int = block_size_bytes) -> dict[tuple[int, int], float]:
+    """
+    Sums the amounts of records in the byte range [start, end) of a csv file per (year, month).
+    """
+    totals = collections.defaultdict(float)
+    periods: dict[str, tuple[int, int]] = {}        # Parsed dates are cached, because dates repeat a lot
+    is_header = start == 0
+
+    with open(path, "rb") as data_file:
+        for block in iter_line_blocks(data_file, start, end, block_size):
+            for row in csv.reader(io.StringIO(block.decode(encoding), newline="")):
+                if is_header:
+                    is_header = False
+                    continue
+                if not row:
+                    continue
+                date = row[i_date]
+                if (period := periods.get(date)) is None:
+                    period = periods[date] = (int(date[:4]), int(date[5:7]))
+                totals[period] += float(row[i_amount])
+
+    return dict(totals)
+
+
+###############
+# Aggregation #
+###############
+
+def get_field_indices(path: str, fields: list[str]) -> list[int]:
+    """
+    Returns the column indices of fields from the csv file header.
+    """
+    with open(path, encoding=encoding, newline="") as data_file:
+        header = next(csv.reader(data_file), None)
+    if not header:
+        raise ValueError(f"{path} has no header row.")
+    missing_fields = [field for field in fields if field not in header]
+    if missing_fields:
+        raise ValueError(f"{path} has no fields {missing_fields}. Header: {header}")
+    return [header.index(field) for field in fields]
+
+
+def aggregate_files(paths: list[str], n_workers: int = None, range_size: int = range_size_bytes) -> dict[tuple[int, int], float]:
+    """
+    Sums the amounts of all records in the csv files per (year, month).
+    Files are split into byte ranges that are aggregated in parallel worker processes.
+    """
+    totals = collections.defaultdict(float)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for path in paths:
+            # Byte ranges are memory-mapped, which needs a regular file (not e.g. a pipe)
+            if not os.path.isfile(path):
+                raise ValueError(f"{path} is not a regular file. Save the export to a file first.")
+            i_date, i_amount = get_field_indices(path, [date_field, amount_field])
+            file_size = os.path.getsize(path)
+            for start in range(0, file_size, range_size):
+                futures.append(executor.submit(aggregate_range, path, start, min(start + range_size, file_size), i_date, i_amount))
+
+        for future in concurrent.futures.as_completed(futures):
+            for period, total in future.result().items():
+                totals[period] += total
+
+    return dict(totals)
+
+
+def write_monthly_series(path: str, country: str, totals: dict[tuple[int, int], float]) -> None:
+    """
+    Writes the monthly totals to the monthly VAT series file.
+    Existing values of the same country and months are replaced, other values are kept.
+    """
+    records = {}
+    if os.path.exists(path):
+        with open(path, newline="") as data_file:
+            for record in csv.DictReader(data_file):
+                records[(record["country"], int(record["year"]), int(record["month"]))] = record["vat_eur"]
+
+    for (year, month), total in totals.items():
+        records[(country, year, month)] = f"{total:.2f}"
+
+    with open(path, "w", newline="") as data_file:
+        writer = csv.writer(data_file, lineterminator="\n")
+        writer.writerow(["country", "year", "month", "vat_eur"])
+        for (record_country, year, month), value in sorted(records.items()):
+            writer.writerow([record_country, year, month, value])
+
+
+#######
+# Run #
+#######
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Aggregate VAT declaration exports into monthly VAT series.")
+    argument_parser.add_argument("paths", nargs="+", help="Declaration export csv files")
+    argument_parser.add_argument("--country", default="EE", help="Country code of the declarations")
+    argument_parser.add_argument("--output", default=vat_data_path, help="Monthly VAT series file to update")
+    argument_parser.add_argument("--workers", type=int, help="Number of worker processes")
+    arguments = argument_parser.parse_args()
+
+    totals = aggregate_files(arguments.paths, arguments.workers)
+    write_monthly_series(arguments.output, arguments.country, totals)
+    for (year, month), total in sorted(totals.items()):
+        print(f"{arguments.country} {year}-{month:02d}: {total:.2f} eur")
@@ -1,137 +1,309 @@
-# Compare the VAT collected in Estonia between 2022 and 2023, adjusted by local CPI to get the effect on consumption.
-import plotly
-from plotly.subplots import make_subplots
+# Compare the VAT collected between years, adjusted by local CPI to get the effect on consumption.
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'figure_export'))
+import chart_cache
+import figure_export
 
 # Sources:
-ee_vat_collected_reference = 'https://public.tableau.com/app/profile/rahandusministeerium.fpo/viz/Maksulaekumine2023/Esitlus'
-ee_cpi_reference = 'https://www.inflation.eu/en/inflation-rates/estonia/historic-inflation/cpi-inflation-estonia-2023.aspx'
-
-vat_monthly_2022_eur = [
-    231432442,
-    221109791,
-    270880742,
-    256942763,
-    281232196,
-    290345187,
-    286783197,
-    290996406,
-    278730363,
-    278661136,
-    286053664,
-    335642138
-]
-
-vat_monthly_2023_eur = [
-    246207779,
-    256028131,
-    290985881,
-    271595136,
-    300069297,
-    307081152,
-    285461595,
-    287576904,
-    281300753,
-    300397535,
-    299555405,
-    350160285
-]
-
-yearly_cpi_2023 = [
-    0.1861,
-    0.1755,
-    0.1528,
-    0.1347,
-    0.1131,
-    0.0919,
-    0.0642,
-    0.0460,
-    0.0423,
-    0.0492,
-    0.0403,
-    0.0403
-]
-
-vat_monthly_2022_cpi_adjusted_eur = [vat * (1 + cpi) for vat, cpi in zip(vat_monthly_2022_eur, yearly_cpi_2023)]
-cumulative_difference = [sum(vat_monthly_2023_eur[i] - vat_monthly_2022_cpi_adjusted_eur[i] for i in range(5, j+1)) for j in range(6, 12)]
+references = {
+    'EE': dict(
+        vat='https://public.tableau.com/app/profile/rahandusministeerium.fpo/viz/Maksulaekumine2023/Esitlus',
+        cpi='https://www.inflation.eu/en/inflation-rates/estonia/historic-inflation/cpi-inflation-estonia-2023.aspx')
+}
+
+country_names = {
+    'EE': 'Estonia'
+}
 
+# Monthly series: country, year, month (1-12) and value
+# CPI is the yearly change, i.e. the change from the same month of the previous year
+vat_data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vat_monthly.csv')
+cpi_data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cpi_yearly.csv')
 
 # Months
 months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
-# Create traces
-vat_2022_trace = plotly.graph_objects.Bar(
-    x=months,
-    y=vat_monthly_2022_cpi_adjusted_eur,
-    name='2022 monthly VAT (CPI adjusted) eur',
-    marker=dict(color='rgb(92, 131, 116)')
-)
-
-vat_2023_trace = plotly.graph_objects.Bar(
-    x=months,
-    y=vat_monthly_2023_eur,
-    name='2023 monthly VAT eur',
-    marker=dict(color='rgb(27, 66, 66)')
-)
-
-difference_trace = plotly.graph_objects.Scatter(
-    x=months[6:],
-    y=cumulative_difference,
-    mode='lines',
-    name='H2 cumulative difference (2023-2022) eur',
-    line=dict(color='rgb(9, 38, 53)', width=1.5)
-)
-
-references_text = f'<b>References</b>:<br>VAT: {ee_vat_collected_reference}<br>CPI: {ee_cpi_reference}'
-
-# Create subplot
-fig = make_subplots(
-    rows=2,
-    cols=1,
-    row_heights=[40, 5],
-    shared_xaxes=True,
-    vertical_spacing=0.05)
-
-# Add bar traces to the first subplot
-fig.add_trace(vat_2022_trace, row=1, col=1)
-fig.add_trace(vat_2023_trace, row=1, col=1)
-
-# Add line trace to the second subplot
-fig.add_trace(difference_trace, row=2, col=1)
-
-# Add label for December of the cumulative graph
-fig.add_trace(plotly.graph_objects.Scatter(
-    x=['Dec'],
-    y=[cumulative_difference[-1]],
-    mode='text',
-    text=[f'{round(cumulative_difference[-1]/1e6)} M'],
-    textposition='top right',
-    showlegend=False
-), row=2, col=1)
-
-# Update layout
-fig.update_layout(
-    title='Monthly VAT Collected in Estonia (2022 vs 2023)',
-    legend=dict(x=0.05, y=1.03, bgcolor='rgba(255, 255, 255, 0)', bordercolor='rgba(255, 255, 255, 0)'),
-    plot_bgcolor='rgba(255, 255, 255, 1)',
-    yaxis_gridcolor='rgba(211, 211, 211, 0.5)',
-    barmode='group',
-    annotations=[
-        dict(
-            x=0.05,
-            y=-0.13,
-            xref='paper',
-            yref='paper',
-            text=references_text,
-            showarrow=False,
-            bgcolor='rgba(255, 255, 255, 0)',
-            align='left'
-        )
-    ],
-    height=800,
-    width=1000,
-    yaxis1_tickfont_size=10,
-    yaxis2_tickfont_size=8.5,
-)
-
-# Save the figure as a PNG file
-fig.write_image("monthly_vat_estonia.png")
+
+class Comparison:
+    """
+    Settings of a single comparison chart: country, base and compare year and the months window of the cumulative difference.
+    """
+    def __init__(self, country: str, base_year: int, compare_year: int, window_start: str = 'Jun', window_end: str = 'Dec') -> None:
+        if base_year >= compare_year:
+            raise ValueError(f'Base year ({base_year}) must be before compare year ({compare_year}).')
+        for month in (window_start, window_end):
+            if month not in months:
+                raise ValueError(f'Unknown window month: {month}. Available months: {", ".join(months)}')
+        if months.index(window_start) > months.index(window_end):
+            raise ValueError(f'Window start ({window_start}) must not be after window end ({window_end}).')
+
+        self.country: str = country
+        self.base_year: int = base_year
+        self.compare_year: int = compare_year
+        self.window_start: str = window_start
+        self.window_end: str = window_end
+
+    def get_name(self) -> str:
+        return f'monthly_vat_{country_names.get(self.country, self.country).lower()}_{self.base_year}_vs_{self.compare_year}'
+
+
+##########
+# Engine #
+##########
+
+def load_monthly_series(path: str, value_field: str) -> dict[tuple[str, int], numpy.ndarray]:
+    """
+    Loads monthly values from a csv file into a 12-element array per country and year. Missing months are NaN.
+    """
+    series = {}
+    with open(path, newline='') as data_file:
+        for record in csv.DictReader(data_file):
+            key = (record['country'], int(record['year']))
+            if key not in series:
+                series[key] = numpy.full(len(months), numpy.nan)
+            series[key][int(record['month']) - 1] = float(record[value_field])
+    return series
+
+
+def get_cpi_adjustment(cpi_series: dict[tuple[str, int], numpy.ndarray], country: str, base_year: int, compare_year: int) -> numpy.ndarray:
+    """
+    Returns monthly factors that scale base year amounts to compare year prices:
+    the product of yearly CPI changes of all years after the base year up to the compare year.
+    """
+    yearly_changes = numpy.stack([cpi_series[(country, year)] for year in range(base_year + 1, compare_year + 1)])
+    return numpy.prod(1 + yearly_changes, axis=0)
+
+
+def get_window_cumulative_sums(values: numpy.ndarray, i_start: int, i_end: int) -> numpy.ndarray:
+    """
+    Returns the cumulative sums of values from index i_start to every index up to i_end (inclusive), using prefix sums.
+    """
+    prefix_sums = numpy.concatenate(([0], numpy.cumsum(values)))
+    return prefix_sums[i_start + 1:i_end + 2] - prefix_sums[i_start]
+
+
+def get_missing_window_months(vat_series: dict, cpi_series: dict, comparison: Comparison) -> list[str]:
+    """
+    Returns the months of the comparison window that are missing VAT data of either year or CPI data of a year in between
+    (e.g. the months of the current year that haven't been published yet).
+    """
+    window = slice(months.index(comparison.window_start), months.index(comparison.window_end) + 1)
+    series = [vat_series[(comparison.country, year)] for year in (comparison.base_year, comparison.compare_year)]
+    series += [cpi_series[(comparison.country, year)] for year in range(comparison.base_year + 1, comparison.compare_year + 1)]
+    is_missing = numpy.isnan(numpy.stack(series)[:, window]).any(axis=0)
+    return [month for month, is_month_missing in zip(months[window], is_missing) if is_month_missing]
+
+
+def compute_comparison(vat_series: dict, cpi_series: dict, comparison: Comparison) -> dict[str, numpy.ndarray]:
+    """
+    Computes the CPI adjusted base year VAT, compare year VAT and the cumulative difference in the comparison window.
+    """
+    missing_vat_years = [year for year in (comparison.base_year, comparison.compare_year) if (comparison.country, year) not in vat_series]
+    missing_cpi_years = [year for year in range(comparison.base_year + 1, comparison.compare_year + 1) if (comparison.country, year) not in cpi_series]
+    if missing_vat_years or missing_cpi_years:
+        raise ValueError(f'No data for comparison {comparison.get_name()}. Missing VAT years: {missing_vat_years}, missing CPI years: {missing_cpi_years}')
+    # The cumulative difference is undefined from the first missing month on
+    if missing_months := get_missing_window_months(vat_series, cpi_series, comparison):
+        raise ValueError(f'Comparison {comparison.get_name()} window {comparison.window_start}-{comparison.window_end} has months without VAT or CPI data: {", ".join(missing_months)}')
+
+    vat_base_eur = vat_series[(comparison.country, comparison.base_year)]
+    vat_compare_eur = vat_series[(comparison.country, comparison.compare_year)]
+    vat_base_cpi_adjusted_eur = vat_base_eur * get_cpi_adjustment(cpi_series, comparison.country, comparison.base_year, comparison.compare_year)
+    cumulative_difference = get_window_cumulative_sums(
+        vat_compare_eur - vat_base_cpi_adjusted_eur,
+        months.index(comparison.window_start),
+        months.index(comparison.window_end))
+
+    return dict(
+        vat_base_cpi_adjusted_eur=vat_base_cpi_adjusted_eur,
+        vat_compare_eur=vat_compare_eur,
+        cumulative_difference=cumulative_difference)
+
+
+def get_default_comparisons(vat_series: dict, cpi_series: dict) -> list[Comparison]:
+    """
+    Returns comparisons of all consecutive year pairs that have VAT and CPI data for all months of the default window.
+    """
+    comparisons = []
+    for country, year in sorted(vat_series):
+        if (country, year + 1) in vat_series and (country, year + 1) in cpi_series:
+            comparison = Comparison(country, year, year + 1)
+            # Skip years with incomplete data, e.g. the current year
+            if not get_missing_window_months(vat_series, cpi_series, comparison):
+                comparisons.append(comparison)
+    return comparisons
+
+
+def get_summary(comparison: Comparison, results: dict[str, numpy.ndarray]) -> dict:
+    """
+    Returns the CPI adjusted yearly totals and the cumulative difference of a comparison.
+    Missing values are None (not NaN, which isn't valid json).
+    """
+    def get_total(values: numpy.ndarray) -> float:
+        return float(numpy.nansum(values)) if not numpy.isnan(values).all() else None
+
+    window_months = months[months.index(comparison.window_start):months.index(comparison.window_end) + 1]
+    cumulative_differences = [float(value) if numpy.isfinite(value) else None for value in results['cumulative_difference']]
+    return dict(
+        country=comparison.country,
+        base_year=comparison.base_year,
+        compare_year=comparison.compare_year,
+        vat_base_cpi_adjusted_total_eur=get_total(results['vat_base_cpi_adjusted_eur']),
+        vat_compare_total_eur=get_total(results['vat_compare_eur']),
+        cumulative_difference_eur=dict(zip(window_months, cumulative_differences)))
+
+
+############
+# Plotting #
+############
+
+def build_figure(comparison: Comparison, results: dict[str, numpy.ndarray]) -> 'plotly.graph_objects.Figure':
+    """
+    Builds the monthly VAT bar chart with the cumulative difference line below it.
+    """
+    # Plotting libraries are imported only when a chart is built, to keep the stats mode startup fast
+    import plotly.graph_objects
+    from plotly.subplots import make_subplots
+
+    base_year, compare_year = comparison.base_year, comparison.compare_year
+    window_months = months[months.index(comparison.window_start):months.index(comparison.window_end) + 1]
+    cumulative_difference = results['cumulative_difference']
+
+    # Create traces
+    vat_base_trace = plotly.graph_objects.Bar(
+        x=months,
+        y=results['vat_base_cpi_adjusted_eur'],
+        name=f'{base_year} monthly VAT (CPI adjusted) eur',
+        marker=dict(color='rgb(92, 131, 116)')
+    )
+
+    vat_compare_trace = plotly.graph_objects.Bar(
+        x=months,
+        y=results['vat_compare_eur'],
+        name=f'{compare_year} monthly VAT eur',
+        marker=dict(color='rgb(27, 66, 66)')
+    )
+
+    difference_trace = plotly.graph_objects.Scatter(
+        x=window_months,
+        y=cumulative_difference,
+        mode='lines',
+        name=f'{comparison.window_start}-{comparison.window_end} cumulative difference ({compare_year}-{base_year}) eur',
+        line=dict(color='rgb(9, 38, 53)', width=1.5)
+    )
+
+    country_references = references.get(comparison.country, {})
+    references_text = f'<b>References</b>:<br>VAT: {country_references.get("vat", "")}<br>CPI: {country_references.get("cpi", "")}'
+
+    # Create subplot
+    fig = make_subplots(
+        rows=2,
+        cols=1,
+        row_heights=[40, 5],
+        shared_xaxes=True,
+        vertical_spacing=0.05)
+
+    # Add bar traces to the first subplot
+    fig.add_trace(vat_base_trace, row=1, col=1)
+    fig.add_trace(vat_compare_trace, row=1, col=1)
+
+    # Add line trace to the second subplot
+    fig.add_trace(difference_trace, row=2, col=1)
+
+    # Add label for the last month of the cumulative graph (if it has a value)
+    if len(cumulative_difference) and numpy.isfinite(cumulative_difference[-1]):
+        fig.add_trace(plotly.graph_objects.Scatter(
+            x=[comparison.window_end],
+            y=[cumulative_difference[-1]],
+            mode='text',
+            text=[f'{round(cumulative_difference[-1]/1e6)} M'],
+            textposition='top right',
+            showlegend=False
+        ), row=2, col=1)
+
+    # Update layout
+    fig.update_layout(
+        title=f'Monthly VAT Collected in {country_names.get(comparison.country, comparison.country)} ({base_year} vs {compare_year})',
+        legend=dict(x=0.05, y=1.03, bgcolor='rgba(255, 255, 255, 0)', bordercolor='rgba(255, 255, 255, 0)'),
+        plot_bgcolor='rgba(255, 255, 255, 1)',
+        yaxis_gridcolor='rgba(211, 211, 211, 0.5)',
+        barmode='group',
+        annotations=[
+            dict(
+                x=0.05,
+                y=-0.13,
+                xref='paper',
+                yref='paper',
+                text=references_text,
+                showarrow=False,
+                bgcolor='rgba(255, 255, 255, 0)',
+                align='left'
+            )
+        ],
+        height=800,
+        width=1000,
+        yaxis1_tickfont_size=10,
+        yaxis2_tickfont_size=8.5,
+    )
+
+    return fig
+
+
+#######
+# Run #
+#######
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Plot CPI adjusted VAT comparison charts.')
+    argument_parser.add_argument('--comparisons', help='Path to a json file with a list of comparison specs (Comparison arguments). Default: all consecutive year pairs')
+    argument_parser.add_argument('--output-dir', default='.', help='Output directory of the charts')
+    argument_parser.add_argument('--stats', action='store_true', help='Print the comparison figures instead of plotting')
+    argument_parser.add_argument('--json', action='store_true', help='Print the comparison figures as json (implies --stats)')
+    arguments = argument_parser.parse_args()
+
+    vat_series = load_monthly_series(vat_data_path, 'vat_eur')
+    cpi_series = load_monthly_series(cpi_data_path, 'cpi_yearly_change')
+
+    if arguments.comparisons:
+        with open(arguments.comparisons) as comparisons_file:
+            comparisons = [Comparison(**comparison_spec) for comparison_spec in json.load(comparisons_file)]
+    else:
+        comparisons = get_default_comparisons(vat_series, cpi_series)
+
+    # Stats mode doesn't import plotting libraries
+    if arguments.stats or arguments.json:
+        summaries = [get_summary(comparison, compute_comparison(vat_series, cpi_series, comparison)) for comparison in comparisons]
+        if arguments.json:
+            print(json.dumps(summaries, indent=2, allow_nan=False))
+        else:
+            def format_millions(value: float) -> str:
+                return f'{value/1e6:.1f} M eur' if value is not None else 'n/a'
+
+            for summary in summaries:
+                print(f"{summary['country']} {summary['base_year']} vs {summary['compare_year']}")
+                print(f"  {summary['base_year']} VAT (CPI adjusted): {format_millions(summary['vat_base_cpi_adjusted_total_eur'])}")
+                print(f"  {summary['compare_year']} VAT: {format_millions(summary['vat_compare_total_eur'])}")
+                for month, difference in summary['cumulative_difference_eur'].items():
+                    print(f"  cumulative difference {month}: {format_millions(difference)}")
+
+    else:
+        # Save the figures as PNG files (via the figure export service, if it's running)
+        # A figure is only rebuilt if its data, comparison settings or this script have changed since the last run
+        cache = chart_cache.ChartCache()
+        script_hash = chart_cache.get_file_hash(__file__)
+        os.makedirs(arguments.output_dir, exist_ok=True)
+        for comparison in comparisons:
+            results = compute_comparison(vat_series, cpi_series, comparison)
+            cache_key = chart_cache.ChartCache.get_key(data=results, spec=dict(comparison=vars(comparison), script=script_hash))
+            image = cache.get_or_render(cache_key, 'png', lambda: figure_export.export_figure(build_figure(comparison, results), 'png'))
+            output_path = os.path.join(arguments.output_dir, f'{comparison.get_name()}.png')
+            with open(output_path, 'wb') as image_file:
+                image_file.write(image)
+            print(output_path)
@@ -0,0 +1,207 @@
+# Benchmark the stages of the salary and VAT data pipelines on synthetic data.
+# No network: the survey csv files and VAT series are generated locally. Results are appended to a results file,
+# so timings of different versions (git commits) can be compared.
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import numpy
+import pandas
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(repository_dir, "salary_analysis"))
+sys.path.append(os.path.join(repository_dir, "Estonian_VAT"))
+import salary_analysis
+import vat_comparison
+
+# Settings
+survey_sizes = [10_000, 100_000, 1_000_000]     # Number of rows in synthetic survey files. Up to 10_000_000 is reasonable
+n_vat_years = 30
+vat_countries = ["EE", "LV", "LT", "FI", "SE"]
+results_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+data_dir = os.path.join(tempfile.gettempdir(), "ad_hoc_benchmark_data")
+
+# Answer pools of the synthetic survey
+roles = ["Andmeanalüütik", "Ärianalüütik", "BI analüütik", "Tarkvaraarendaja", "Arendaja", "Projektijuht", "Testija", "Süsteemiadministraator"]
+education_levels = ["", "Põhiharidus", "Kutseharidus", "Keskharidus", "Rakenduskõrgharidus", "Bakalaureusekraad", "Magistrikraad", "Doktorikraad"]
+
+
+##################
+# Synthetic data #
+##################
+
+def get_survey_path(n_rows: int, seed: int = 0) -> str:
+    """
+    Returns the path of a synthetic survey csv with the columns of the real survey. Generates the file if it doesn't exist.
+    """
+    path = os.path.join(data_dir, f"survey_{n_rows}_{seed}.csv")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(data_dir, exist_ok=True)
+    random = numpy.random.default_rng(seed)
+    experience = random.integers(0, 40, n_rows).astype(str)
+    experience[random.random(n_rows) < 0.1] = ""        # Some experience answers are missing
+    survey = pandas.DataFrame({
+        "Ametikoht": numpy.array(roles)[random.integers(0, len(roles), n_rows)],
+        "Brutopalk": random.lognormal(8.2, 0.4, n_rows).round(),
+        "Kogemus valdkonnas": experience,
+        "Sinu vanus?": random.integers(20, 65, n_rows),
+        "Haridustase": numpy.array(education_levels)[random.integers(0, len(education_levels), n_rows)]})
+    survey.to_csv(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def get_vat_series(seed: int = 0) -> tuple[dict, dict]:
+    """
+    Returns synthetic monthly VAT and yearly CPI change series for n_vat_years years and vat_countries.
+    """
+    random = numpy.random.default_rng(seed)
+    vat_series = {}
+    cpi_series = {}
+    for country in vat_countries:
+        for year in range(2000, 2000 + n_vat_years):
+            vat_series[(country, year)] = random.uniform(2e8, 3.5e8, len(vat_comparison.months))
+            cpi_series[(country, year)] = random.normal(0.03, 0.02, len(vat_comparison.months))
+    return vat_series, cpi_series
+
+
+##########
+# Timing #
+##########
+
+def time_stage(function: Callable, n_repeats: int) -> tuple[float, object]:
+    """
+    Returns the best wall time in seconds of n_repeats runs of the function and the result of the last run.
+    """
+    durations = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return min(durations), result
+
+
+def benchmark_salary(n_rows: int, n_repeats: int) -> dict[str, float]:
+    """
+    Times the salary pipeline stages on a synthetic survey of n_rows rows.
+    """
+    view = salary_analysis.View()
+    with open(get_survey_path(n_rows), encoding="utf8") as survey_file:
+        csv_text = survey_file.read()
+
+    timings = {}
+    timings["ingest"], table = time_stage(lambda: salary_analysis.read_table(csv_text, view.get_fields()), n_repeats)
+    timings["filter"], filtered_table = time_stage(lambda: salary_analysis.filter_table(table, salary_analysis.filter_field, view.filter_regex_pattern), n_repeats)
+    timings["clean"], plot_data = time_stage(lambda: salary_analysis.clean_data(filtered_table, view), n_repeats)
+    timings["colour_map"], _ = time_stage(lambda: salary_analysis.get_colour_data(filtered_table, view), n_repeats)
+    x_data, y_data, label_data, colour_data = plot_data
+    timings["aggregate"], _ = time_stage(lambda: salary_analysis.get_summary(x_data, y_data, colour_data, view), n_repeats)
+    timings["sketch"], _ = time_stage(lambda: salary_analysis.QuantileSketch().add(x_data), n_repeats)
+    timings["figure_build"], figure = time_stage(lambda: salary_analysis.build_figure(x_data, y_data, label_data, colour_data, view), n_repeats)
+    timings["figure_serialize"], figure_json = time_stage(figure.to_json, n_repeats)
+    timings["figure_json_bytes"] = len(figure_json)
+    return timings
+
+
+def benchmark_vat(n_repeats: int) -> dict[str, float]:
+    """
+    Times the VAT comparison stages on synthetic series: all year pairs of all countries and the charts of consecutive years.
+    """
+    vat_series, cpi_series = get_vat_series()
+    all_comparisons = [
+        vat_comparison.Comparison(country, base_year, compare_year, "Jan", "Dec")
+        for country in vat_countries
+        for base_year in range(2000, 2000 + n_vat_years)
+        for compare_year in range(base_year + 1, 2000 + n_vat_years)]
+    consecutive_comparisons = vat_comparison.get_default_comparisons(vat_series, cpi_series)
+
+    def build_figures() -> None:
+        for comparison in consecutive_comparisons:
+            vat_comparison.build_figure(comparison, vat_comparison.compute_comparison(vat_series, cpi_series, comparison))
+
+    timings = {}
+    timings["aggregate"], _ = time_stage(lambda: [vat_comparison.compute_comparison(vat_series, cpi_series, comparison) for comparison in all_comparisons], n_repeats)
+    timings["figure_build"], _ = time_stage(build_figures, n_repeats)
+    timings["n_comparisons"] = len(all_comparisons)
+    timings["n_figures"] = len(consecutive_comparisons)
+    return timings
+
+
+###########
+# Results #
+###########
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repository_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def print_comparison(result: dict, previous_result: dict) -> None:
+    """
+    Prints the timings of the result next to a previous result, with the ratio (current / previous) of every stage.
+    """
+    print(f"\nCompared to commit {previous_result['commit']} ({previous_result['timestamp']}):")
+    for benchmark_name, timings in result["benchmarks"].items():
+        previous_timings = previous_result["benchmarks"].get(benchmark_name, {})
+        for stage, duration in timings.items():
+            # Only timings are compared, not counts
+            if not isinstance(duration, float) or not previous_timings.get(stage):
+                continue
+            ratio = duration / previous_timings[stage]
+            flag = "  <- slower" if ratio > 1.2 else ""
+            print(f"  {benchmark_name} {stage}: {previous_timings[stage]:.4g} -> {duration:.4g} ({ratio:.2f}x){flag}")
+
+
+#######
+# Run #
+#######
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Benchmark the salary and VAT data pipeline stages on synthetic data.")
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=survey_sizes, help="Numbers of rows of the synthetic surveys")
+    argument_parser.add_argument("--repeats", type=int, default=3, help="Number of runs per stage (best time is reported)")
+    argument_parser.add_argument("--results", default=results_path, help="File that the results are appended to")
+    arguments = argument_parser.parse_args()
+
+    benchmarks = {}
+    for n_rows in arguments.sizes:
+        benchmarks[f"salary_{n_rows}"] = benchmark_salary(n_rows, arguments.repeats)
+    benchmarks["vat"] = benchmark_vat(arguments.repeats)
+
+    result = dict(
+        timestamp=datetime.datetime.now().isoformat(timespec="seconds"),
+        commit=get_commit(),
+        python=platform.python_version(),
+        machine=platform.node(),
+        benchmarks=benchmarks)
+
+    for benchmark_name, timings in benchmarks.items():
+        print(benchmark_name)
+        for stage, value in timings.items():
+            print(f"  {stage}: {value:.4g} s" if isinstance(value, float) else f"  {stage}: {value}")
+
+    # Compare to the latest result of another commit on the same machine
+    previous_results = [previous for previous in load_results(arguments.results) if previous["machine"] == result["machine"] and previous["commit"] != result["commit"]]
+    if previous_results:
+        print_comparison(result, previous_results[-1])
+
+    with open(arguments.results, "a") as results_file:
+        results_file.write(json.dumps(result) + "\n")
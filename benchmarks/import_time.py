@@ -0,0 +1,49 @@
+# Measure the startup time of the analysis scripts in stats mode (no plotting imports) vs plotting mode.
+# Every measurement runs in a fresh interpreter, so module caching doesn't affect the results.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Script directory and the statements that import what each mode needs
+# Newer plotly versions load graph objects lazily, so plotting mode also creates an empty figure to include that cost
+# salary_analysis plotting mode also parses the sheet with pandas, while stats mode streams it with csv + numpy
+scenarios = {
+    "salary_analysis": dict(
+        directory=os.path.join(repository_dir, "salary_analysis"),
+        stats="import salary_analysis",
+        plot="import salary_analysis, pandas, plotly.colors, plotly.graph_objects; plotly.graph_objects.Figure(plotly.graph_objects.Scatter())"),
+    "vat_comparison": dict(
+        directory=os.path.join(repository_dir, "Estonian_VAT"),
+        stats="import vat_comparison",
+        plot="import vat_comparison, plotly.graph_objects, plotly.subplots; plotly.subplots.make_subplots(rows=2, cols=1).add_trace(plotly.graph_objects.Bar(), row=1, col=1)"),
+}
+
+
+def measure(statement: str, directory: str, n_repeats: int) -> float:
+    """
+    Returns the median wall time in seconds of running the statement in a new interpreter.
+    """
+    durations = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=directory, check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Measure stats mode vs plotting mode startup time of the analysis scripts.")
+    argument_parser.add_argument("--repeats", type=int, default=5, help="Number of measurements per scenario (median is reported)")
+    arguments = argument_parser.parse_args()
+
+    interpreter_time = measure("pass", repository_dir, arguments.repeats)
+    print(f"interpreter startup: {interpreter_time * 1000:.0f} ms")
+    for script_name, scenario in scenarios.items():
+        stats_time = measure(scenario["stats"], scenario["directory"], arguments.repeats)
+        plot_time = measure(scenario["plot"], scenario["directory"], arguments.repeats)
+        print(f"{script_name}: stats mode {stats_time * 1000:.0f} ms, plotting mode {plot_time * 1000:.0f} ms, difference {(plot_time - stats_time) * 1000:.0f} ms")
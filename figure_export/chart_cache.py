@@ -0,0 +1,124 @@
+# Content-addressed on-disk cache of rendered charts.
+# Charts are keyed by a hash of their normalised input data and figure spec, so unchanged charts are not rebuilt.
+import hashlib
+import os
+from typing import Callable
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ad_hoc_charts")
+CACHE_DIR_VARIABLE = "CHART_CACHE_DIR"          # Environment variable to set a non-default cache directory
+DEFAULT_MAX_SIZE_BYTES = 512 * 2**20
+
+
+def update_hash(content_hash: "hashlib._Hash", value: object) -> None:
+    """
+    Feeds a normalised representation of the value to the hash.
+    Dicts are hashed in key order, sequences element by element, arrays by their raw bytes and numpy scalars as Python scalars.
+    """
+    if isinstance(value, dict):
+        content_hash.update(b"{")
+        for key in sorted(value):
+            update_hash(content_hash, key)
+            update_hash(content_hash, value[key])
+        content_hash.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        content_hash.update(b"[")
+        for element in value:
+            update_hash(content_hash, element)
+        content_hash.update(b"]")
+    elif getattr(value, "ndim", 1) == 0 and hasattr(value, "item"):
+        # numpy scalars (and 0-d arrays) are hashed like the equivalent Python scalars
+        update_hash(content_hash, value.item())
+    elif hasattr(value, "tobytes") and getattr(getattr(value, "dtype", None), "kind", None) != "O":
+        # numpy arrays (except object arrays, whose bytes are pointers) and array.array
+        content_hash.update(f"array:{getattr(value, 'dtype', getattr(value, 'typecode', ''))}:{len(value)}:".encode())
+        content_hash.update(value.tobytes())
+    elif hasattr(value, "tolist"):
+        update_hash(content_hash, value.tolist())
+    else:
+        content_hash.update(f"{type(value).__name__}:{value!r};".encode())
+
+
+def get_file_hash(path: str) -> str:
+    """
+    Returns the hash of a file's content. Used to invalidate cached charts when the script that draws them changes.
+    """
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class ChartCache:
+    """
+    On-disk cache of rendered charts (images or html) with size-bounded least recently used eviction.
+    """
+    def __init__(self, directory: str = None, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES) -> None:
+        self.directory: str = directory or os.environ.get(CACHE_DIR_VARIABLE) or DEFAULT_CACHE_DIR
+        self.max_size_bytes: int = max_size_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(data: object, spec: object) -> str:
+        """
+        Returns the content address of a chart: a hash of its input data and figure spec.
+        """
+        content_hash = hashlib.sha256()
+        update_hash(content_hash, data)
+        update_hash(content_hash, spec)
+        return content_hash.hexdigest()
+
+    def get_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def get(self, key: str, extension: str) -> bytes:
+        """
+        Returns the cached chart or None if it's not in cache.
+        """
+        path = self.get_path(key, extension)
+        try:
+            with open(path, "rb") as chart_file:
+                content = chart_file.read()
+        except FileNotFoundError:
+            return None
+        # Modification time is used as last access time for eviction
+        os.utime(path)
+        return content
+
+    def put(self, key: str, extension: str, content: bytes) -> None:
+        """
+        Stores a chart in cache and evicts least recently used charts if the cache is over size limit.
+        """
+        path = self.get_path(key, extension)
+        # Write to a temporary file first, so concurrent readers never see a partial chart
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as chart_file:
+            chart_file.write(content)
+        os.replace(temporary_path, path)
+        self.evict()
+
+    def get_or_render(self, key: str, extension: str, render: Callable[[], bytes]) -> bytes:
+        """
+        Returns the cached chart or renders and caches it if it's not in cache.
+        """
+        if (content := self.get(key, extension)) is None:
+            content = render()
+            self.put(key, extension, content)
+        return content
+
+    def evict(self) -> None:
+        """
+        Removes least recently used charts until the cache fits the size limit.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if cache_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            cache_size -= size
@@ -0,0 +1,180 @@
+# Long-lived figure export service shared by the plotting scripts.
+# Keeps warm image export worker processes, so exporting N charts costs one engine startup plus N renders.
+import argparse
+import concurrent.futures
+import http.server
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# plotly is imported in the functions that use it, so importing the client doesn't slow down the scripts' startup
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+SERVICE_URL_VARIABLE = "FIGURE_EXPORT_URL"      # Environment variable to point the scripts to a non-default service address
+IMAGE_FORMATS = {                               # Supported image formats and their content types
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "pdf": "application/pdf"}
+
+
+##########
+# Worker #
+##########
+
+def start_export_engine() -> None:
+    """
+    Starts the image export engine in a worker process by rendering an empty figure.
+    """
+    import kaleido
+    import plotly.graph_objects
+    import plotly.io
+    # Newer kaleido versions run a browser that stays alive between renders only in server mode
+    if start_sync_server := getattr(kaleido, "start_sync_server", None):
+        start_sync_server(silence_warnings=True)
+    plotly.io.to_image(plotly.graph_objects.Figure(), format="png")
+
+
+def render_figure(figure_json: str, image_format: str = "png", width: int = None, height: int = None, scale: float = None) -> bytes:
+    """
+    Renders a figure from its json representation to image bytes.
+    """
+    import plotly.io
+    figure = plotly.io.from_json(figure_json)
+    return plotly.io.to_image(figure, format=image_format, width=width, height=height, scale=scale)
+
+
+class ExportPool:
+    """
+    Pool of worker processes with warm image export engines.
+    """
+    def __init__(self, n_workers: int = None) -> None:
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, initializer=start_export_engine)
+
+    def submit(self, figure_json: str, image_format: str = "png", **kwargs) -> concurrent.futures.Future:
+        """
+        Submits a figure for export. The future result is the image bytes.
+        """
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}. Available formats: {', '.join(IMAGE_FORMATS)}")
+        return self.executor.submit(render_figure, figure_json, image_format, **kwargs)
+
+    def export(self, figure_json: str, image_format: str = "png", **kwargs) -> bytes:
+        return self.submit(figure_json, image_format, **kwargs).result()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+###########
+# Service #
+###########
+
+class ExportRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handles export requests: POST /export?format=png&width=1000&height=800&scale=1 with figure json as body.
+    """
+    def do_POST(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/export":
+            self.send_error(404)
+            return
+
+        if self.headers["Content-Length"] is None:
+            self.send_error(411)
+            return
+
+        # Invalid requests are rejected before rendering
+        query = dict(urllib.parse.parse_qsl(url.query))
+        image_format = query.get("format", "png")
+        if image_format not in IMAGE_FORMATS:
+            self.send_error(400, explain=f"Unsupported image format: {image_format}. Available formats: {', '.join(IMAGE_FORMATS)}")
+            return
+        try:
+            size_arguments = {key: int(query[key]) for key in ("width", "height") if key in query}
+            if "scale" in query:
+                size_arguments["scale"] = float(query["scale"])
+            content_length = int(self.headers["Content-Length"])
+        except ValueError as error:
+            self.send_error(400, explain=str(error))
+            return
+        figure_json = self.rfile.read(content_length).decode("utf8")
+
+        try:
+            image = self.server.export_pool.export(figure_json, image_format, **size_arguments)
+        except Exception as error:
+            self.send_error(500, explain=str(error))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", IMAGE_FORMATS[image_format])
+        self.send_header("Content-Length", str(len(image)))
+        self.end_headers()
+        self.wfile.write(image)
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, n_workers: int = None) -> None:
+    """
+    Runs the export service until interrupted. Requests are handled concurrently by the worker pool.
+    """
+    export_pool = ExportPool(n_workers)
+    server = http.server.ThreadingHTTPServer((host, port), ExportRequestHandler)
+    server.export_pool = export_pool
+    print(f"Figure export service running on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        export_pool.close()
+
+
+##########
+# Client #
+##########
+
+def export_figure(figure: "plotly.graph_objects.Figure", image_format: str = "png", service_url: str = None, timeout: float = 120) -> bytes:
+    """
+    Renders the figure to image bytes in the export service.
+    Falls back to rendering in the current process if the service is not running or doesn't respond in time.
+    """
+    service_url = service_url or os.environ.get(SERVICE_URL_VARIABLE) or f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+    request = urllib.request.Request(
+        f"{service_url}/export?format={image_format}",
+        data=figure.to_json().encode("utf8"),
+        headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read()
+    except urllib.error.HTTPError:
+        raise
+    # Read timeouts and dropped connections are raised as is, not wrapped in URLError
+    except (urllib.error.URLError, TimeoutError, ConnectionError):
+        return figure.to_image(format=image_format)
+
+
+def write_figure(figure: "plotly.graph_objects.Figure", path: str, service_url: str = None) -> None:
+    """
+    Exports the figure via the export service and writes it to file. Image format is determined by the file extension.
+    """
+    image_format = os.path.splitext(path)[1].lstrip(".").lower()
+    image = export_figure(figure, image_format, service_url)
+    with open(path, "wb") as image_file:
+        image_file.write(image)
+
+
+#######
+# Run #
+#######
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Run the figure export service.")
+    argument_parser.add_argument("--host", default=DEFAULT_HOST)
+    argument_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    argument_parser.add_argument("--workers", type=int, help="Number of warm export worker processes")
+    arguments = argument_parser.parse_args()
+
+    serve(arguments.host, arguments.port, arguments.workers)
@@ -1,3 +1,4 @@
+import math
 import os
 import random
 import time
@@ -209,8 +210,9 @@ class Cell:
         Returns the cell character in correct colour if it is visible (i.e. "lit") or blank character if it's not visible.
         """
         if self.is_lit:
-            active_character = self.get_active_character()
+            # Colour is determined once per frame and reused for the character
             active_colour = self.get_active_colour()
+            active_character = self.get_active_character(active_colour)
             return CharacterManipulation.get_coloured_character(active_character, active_colour)
         return CharacterManipulation.BLANK_CHARACTER
 
@@ -225,12 +227,14 @@ class Cell:
             return drop_colour
         return self.default_colour
 
-    def get_active_character(self):
+    def get_active_character(self, active_colour: int = None):
         """
         Returns the default character or override character of the cell - or blank character if cell colour is set to invisible.
         """
+        if active_colour is None:
+            active_colour = self.get_active_colour()
         # Black doesn't look good on screen, so we return a blank character instead
-        if self.get_active_colour() == self.INIVISIBLE_COLOUR:
+        if active_colour == self.INIVISIBLE_COLOUR:
             return CharacterManipulation.BLANK_CHARACTER
         return self.override_character or self.character
 
@@ -405,6 +409,7 @@ class Matrix:
         self.messages: list[tuple[Message, int]] = []       # Message object and the index of the column it's applied to (allows to control that every column only has one message)
         self.active_drop_probability: float = self.DROP_PROBABLITY      # Duplicated drop probability variable is set, because it changes when "stopping" the rain
         self.rain_active: bool = True                       # Variable to indicate if the rain stop sequence should be started
+        self.drop_positions: set[tuple[int, int]] = set()   # Positions (row, column) of cells that are part of a drop. Only these cells are updated when drops move
 
         # Populate the matrix
         for _ in range(self.n_rows):
@@ -415,7 +420,8 @@ class Matrix:
         """
         Returns the string that is printed on screen.
         """
-        return "".join("".join(str(cell) for cell in row) for row in self.rows)
+        # Blank cells are most of the matrix, so they are added without the Cell.__str__ call
+        return "".join(str(cell) if cell.is_lit else CharacterManipulation.BLANK_CHARACTER for row in self.rows for cell in row)
     
     def set_ascii_image(self, ascii_image: AsciiImage) -> None:
         """
@@ -426,46 +432,58 @@ class Matrix:
             for i_column, is_ascii_image in enumerate(image_row):
                 self.rows[i_row][i_column].is_ascii_image = is_ascii_image
         
-        # Make a register of ascii image top edge cells to be used when "washing" away the image
-        self.image_top_cells = []
+        # Make a register of ascii image top edge cell positions (row, column) to be used when "washing" away the image
+        self.image_top_cell_positions = []
         for i_column in range(len(self.rows[0])):
             for i_row, row in enumerate(self.rows):
                 cell = row[i_column]
                 if cell.is_ascii_image:
-                    self.image_top_cells += [cell]
+                    self.image_top_cell_positions += [(i_row, i_column)]
                     continue
 
         self.ascii_image_active = False
 
+    def set_drop_head(self, i_row: int, i_column: int, drop_length: int) -> None:
+        """
+        Sets the cell in given position as the first cell of an incoming drop and registers it as a drop cell.
+        """
+        self.rows[i_row][i_column].set_drop_head(drop_length)
+        self.drop_positions.add((i_row, i_column))
+
     def move_drops(self) -> None:
         """
-        Cycles through all cells in the matrix and updates their positions in drops to advance frame.
-        """
-        # Iterate through rows from second to last
-        # Iteration starts from the bottom row, because next frame of a cell depends on the state of the cell above
-        for i_row_above, row in reversed(list(enumerate(self.rows[1:]))):
-            for i_column, current_cell in enumerate(row):
-                # Advance frame of each cell
-                current_cell.move_drop(image_active = self.ascii_image_active)
-                # If the cell above is drop head, set the current cell as drop head for next frame
-                cell_above = self.rows[i_row_above][i_column]
-                if cell_above.drop and cell_above.position_in_drop == 0:
-                    current_cell.set_drop_head(drop_length=cell_above.drop.length)
-        
-        # Iterate through first row separately, because there is no row above
-        for first_row_cell in self.rows[0]:
-            first_row_cell.move_drop(image_active = self.ascii_image_active)
+        Cycles through the cells that are part of a drop and updates their positions in drops to advance frame.
+        The cost depends on the number of drop cells, not on the size of the matrix.
+        """
+        # Next frame of a cell depends on the state of the cell above in the current frame, so drop heads are collected before moving
+        drop_heads = []
+        for i_row, i_column in self.drop_positions:
+            cell = self.rows[i_row][i_column]
+            if cell.position_in_drop == 0:
+                drop_heads += [(i_row, i_column, cell.drop.length)]
+
+        # Advance frame of each drop cell and unregister the cells that the drop has passed
+        for i_row, i_column in list(self.drop_positions):
+            cell = self.rows[i_row][i_column]
+            cell.move_drop(image_active = self.ascii_image_active)
+            if not cell.drop:
+                self.drop_positions.discard((i_row, i_column))
+
+        # If the cell above is drop head, set the current cell as drop head for next frame
+        for i_row_above, i_column, drop_length in drop_heads:
+            if i_row_above + 1 < self.n_rows:
+                self.set_drop_head(i_row_above + 1, i_column, drop_length)
 
     def spawn_drops(self) -> None:
         """
         Spawn new drops in the first row with currently active drop probability.
         """
-        for cell in self.rows[0]:
+        for i_column in range(self.n_columns):
             if random.random() > self.active_drop_probability:
                 continue
 
             drop_length = random.randint(self.MIN_DROP_LENGTH, self.MAX_DROP_LENGTH)
-            cell.set_drop_head(drop_length)
+            self.set_drop_head(0, i_column, drop_length)
 
     def spawn_ascii_image_washing_drops(self) -> None:
         """
@@ -475,16 +493,16 @@ class Matrix:
             return
         
         # Only initiate drops in currently lit non-drop cells
-        image_top_cells_active = [cell for cell in self.image_top_cells if cell.is_lit and not cell.drop]
-        if not image_top_cells_active:
+        image_top_cell_positions_active = [(i_row, i_column) for i_row, i_column in self.image_top_cell_positions if (cell := self.rows[i_row][i_column]).is_lit and not cell.drop]
+        if not image_top_cell_positions_active:
             return
 
         # Increase drop probablity as less cells remain in the image top boundary (for better visual)
-        drop_probability_start: float = Matrix.DROP_PROBABLITY / 30
+        drop_probability_start: float = self.DROP_PROBABLITY / 30
         drop_probability_end: float = 0.05
 
-        n_top_boundary_cells_initial = len(self.image_top_cells)
-        n_top_boundary_cells_remaining = len(image_top_cells_active)
+        n_top_boundary_cells_initial = len(self.image_top_cell_positions)
+        n_top_boundary_cells_remaining = len(image_top_cell_positions_active)
 
         # Increase wash drop probability in cubic progression for slow degradation in the beginning and fast in the end
         gradual_change = GradualChange(
@@ -493,11 +511,11 @@ class Matrix:
             n_steps=n_top_boundary_cells_initial)
         drop_probablity = gradual_change.get_accelerating_probability(n_top_boundary_cells_initial - n_top_boundary_cells_remaining)
 
-        for cell in image_top_cells_active:
+        for i_row, i_column in image_top_cell_positions_active:
             if random.random() > drop_probablity:
                 continue
             drop_length = random.randint(self.MIN_DROP_LENGTH, self.MAX_DROP_LENGTH)
-            cell.set_drop_head(drop_length)
+            self.set_drop_head(i_row, i_column, drop_length)
 
     def change_rain_decelerating(self, target_drop_probability: float, change_time_elapsed_seconds: float, change_duration_seconds: float) -> None:
         """
@@ -516,12 +534,19 @@ class Matrix:
         Spawn new glitches in random cells.
         """
         cells_to_glitch = []
+        if self.GLITCH_PROBABILITY <= 0:
+            return
         # Choose random cells to glitch.
         # One cell could be added several times.
-        for row in self.rows:
-            for cell in row:
-                if random.random() < self.GLITCH_PROBABILITY:
-                    cells_to_glitch += [cell]
+        # Instead of drawing a random number per cell, skip to the next glitching cell by a geometrically distributed gap.
+        # Every cell still glitches with GLITCH_PROBABILITY, but the cost depends on the number of glitches, not on the size of the matrix.
+        log_no_glitch_probability = math.log1p(-min(self.GLITCH_PROBABILITY, 1 - 1e-12))
+        i_cell = -1
+        while True:
+            i_cell += 1 + int(math.log(1 - random.random()) / log_no_glitch_probability)
+            if i_cell >= self.n_rows * self.n_columns:
+                break
+            cells_to_glitch += [self.rows[i_cell // self.n_columns][i_cell % self.n_columns]]
 
         self.glitches += [Glitch(cell) for cell in cells_to_glitch]
     
@@ -541,6 +566,19 @@ class Matrix:
         """
         self.message_texts: list = message_texts
 
+    def set_load_settings(self, load_settings: dict) -> None:
+        """
+        Overrides load-related class settings (e.g. DROP_PROBABLITY) for this matrix.
+        """
+        for setting_name, value in load_settings.items():
+            setattr(self, setting_name, value)
+        # Don't override the drop probability if the rain is being stopped
+        if self.rain_active:
+            self.active_drop_probability = self.DROP_PROBABLITY
+        # Delete the oldest messages that are over the concurrent messages limit
+        for message, _ in self.messages[:max(len(self.messages) - self.N_CONCURRENT_MESSAGES, 0)]:
+            message.delete()
+
     def spawn_message(self) -> None:
         """
         Selects a random message from available message texts, obfuscates it and places it in the matrix.
@@ -585,6 +623,134 @@ class Matrix:
             self.messages[0][0].delete()
 
 
+################
+# Load classes #
+################
+
+class Calibration:
+    """
+    Class for fitting the animation load to the frame budget of the machine.
+    Binary-searches the fidelity levels with short headless runs for the highest level that fits the budget.
+    """
+    # Load settings from the highest to the lowest fidelity (i.e. from the highest to the lowest frame cost).
+    # The first level equals the Matrix class defaults.
+    FIDELITY_LEVELS: list[dict] = [
+        dict(DROP_PROBABLITY=0.01, GLITCH_PROBABILITY=0.0002, N_CONCURRENT_MESSAGES=40, MAX_DROP_LENGTH=25),
+        dict(DROP_PROBABLITY=0.008, GLITCH_PROBABILITY=0.0001, N_CONCURRENT_MESSAGES=30, MAX_DROP_LENGTH=21),
+        dict(DROP_PROBABLITY=0.006, GLITCH_PROBABILITY=0.00005, N_CONCURRENT_MESSAGES=20, MAX_DROP_LENGTH=17),
+        dict(DROP_PROBABLITY=0.0045, GLITCH_PROBABILITY=0.00002, N_CONCURRENT_MESSAGES=12, MAX_DROP_LENGTH=13),
+        dict(DROP_PROBABLITY=0.002, GLITCH_PROBABILITY=0.0, N_CONCURRENT_MESSAGES=4, MAX_DROP_LENGTH=8),
+    ]
+    N_MEASURED_FRAMES: int = 100            # Maximum number of measured frames per fidelity level. The binary search measures at most 3 levels
+    N_MIN_MEASURED_FRAMES: int = 10         # Number of frames that are measured even if the time limit is reached
+    TIME_LIMIT_SECONDS: float = 6           # Total calibration time limit (warm-up included), so the screen isn't blank for long
+    BUDGET_UTILISATION: float = 0.8         # Fraction of the frame budget that headless frames may use. The rest is left for terminal output
+    ABORT_FACTOR: float = 2                 # Stop measuring a level early if its frames take this many times the budget
+
+    def __init__(self, n_rows: int, n_columns: int, frame_budget_seconds: float, ascii_image: AsciiImage, message_texts: list[str]) -> None:
+        self.n_rows: int = n_rows
+        self.n_columns: int = n_columns
+        self.frame_budget_seconds: float = frame_budget_seconds
+        self.ascii_image: AsciiImage = ascii_image
+        self.message_texts: list[str] = message_texts
+
+    def measure_frame_time(self, load_settings: dict, time_limit_seconds: float) -> float:
+        """
+        Runs headless frames with the given load settings and returns the 90th percentile frame computation time.
+        """
+        matrix = Matrix(self.n_rows, self.n_columns)
+        matrix.set_ascii_image(self.ascii_image)
+        matrix.set_message_texts(self.message_texts)
+        matrix.set_load_settings(load_settings)
+        animation = Animation(matrix)
+        start = time.perf_counter()
+
+        # Warm up without rendering the frames: it takes n_rows frames for the first drops to cross the screen
+        # Warm-up may use half of the time limit. If it's cut short, the load is underestimated and the load controller corrects it later
+        for _ in range(self.n_rows):
+            animation.update_frame()
+            if time.perf_counter() - start > time_limit_seconds / 2:
+                break
+
+        frame_times = []
+        for _ in range(self.N_MEASURED_FRAMES):
+            frame_start = time.perf_counter()
+            animation.update_frame()
+            str(matrix)
+            frame_times.append(time.perf_counter() - frame_start)
+            if len(frame_times) < self.N_MIN_MEASURED_FRAMES:
+                continue
+            if time.perf_counter() - start > time_limit_seconds or sum(frame_times) / len(frame_times) > self.ABORT_FACTOR * self.frame_budget_seconds:
+                break
+
+        frame_times.sort()
+        return frame_times[int(0.9 * (len(frame_times) - 1))]
+
+    def run(self) -> int:
+        """
+        Returns the index of the highest fidelity level that fits the frame budget (or the lowest level if none fits).
+        """
+        # Levels are ordered by cost, so a binary search only needs to measure ceil(log2(number of levels)) levels
+        n_measurements = math.ceil(math.log2(len(self.FIDELITY_LEVELS)))
+        i_first, i_last = 0, len(self.FIDELITY_LEVELS) - 1        # The highest fitting level is between these levels
+        while i_first < i_last:
+            i_middle = (i_first + i_last) // 2
+            frame_time = self.measure_frame_time(self.FIDELITY_LEVELS[i_middle], self.TIME_LIMIT_SECONDS / n_measurements)
+            if frame_time <= self.BUDGET_UTILISATION * self.frame_budget_seconds:
+                i_last = i_middle
+            else:
+                i_first = i_middle + 1
+        return i_first
+
+
+class LoadController:
+    """
+    Class for keeping the frame time within the frame budget during animation.
+    Steps the fidelity level down when the average frame time drifts over budget and back up when there is plenty of headroom.
+    """
+    SMOOTHING: float = 0.05                 # Weight of the latest frame in the moving average frame time
+    DOWNGRADE_THRESHOLD: float = 0.9        # Fraction of the frame budget above which the fidelity level is lowered
+    UPGRADE_THRESHOLD: float = 0.4          # Fraction of the frame budget below which the fidelity level is raised
+    N_SETTLE_FRAMES: int = 100              # Number of frames to wait after a level change before the next change
+
+    def __init__(self, matrix: Matrix, frame_budget_seconds: float, i_level: int) -> None:
+        self.frame_budget_seconds: float = frame_budget_seconds
+        self.i_level: int = i_level
+        self.average_frame_time: float = None
+        self.n_frames_since_change: int = 0
+
+        self.set_matrix(matrix)
+
+    def set_matrix(self, matrix: Matrix) -> None:
+        """
+        Sets the matrix whose load is controlled and applies the current fidelity level to it.
+        Allows to keep the level that was reached during the previous animation run.
+        """
+        self.matrix: Matrix = matrix
+        self.matrix.set_load_settings(Calibration.FIDELITY_LEVELS[self.i_level])
+
+    def register_frame_time(self, frame_time: float) -> None:
+        """
+        Updates the moving average frame time and changes the fidelity level if needed.
+        """
+        if self.average_frame_time is None:
+            self.average_frame_time = frame_time
+        self.average_frame_time += self.SMOOTHING * (frame_time - self.average_frame_time)
+        self.n_frames_since_change += 1
+
+        if self.n_frames_since_change < self.N_SETTLE_FRAMES:
+            return
+        if self.average_frame_time > self.DOWNGRADE_THRESHOLD * self.frame_budget_seconds and self.i_level < len(Calibration.FIDELITY_LEVELS) - 1:
+            self.set_level(self.i_level + 1)
+        elif self.average_frame_time < self.UPGRADE_THRESHOLD * self.frame_budget_seconds and self.i_level > 0:
+            self.set_level(self.i_level - 1)
+
+    def set_level(self, i_level: int) -> None:
+        self.i_level = i_level
+        self.matrix.set_load_settings(Calibration.FIDELITY_LEVELS[self.i_level])
+        self.n_frames_since_change = 0
+
+
 #####################
 # Animation classes #
 #####################
@@ -632,11 +798,12 @@ class Animation:
     """
     Class for orchestrating the matrix animation in terminal.
     """
-    FRAME_SLEEP_PERIOD_SECONDS: float = 0.06            # Sets the speed of falling drops
+    FRAME_SLEEP_PERIOD_SECONDS: float = 0.06            # Sets the speed of falling drops. Time between frames, i.e. the frame budget
 
     def __init__(self, matrix: Matrix) -> None:
         self.matrix = matrix
         self.is_running = False
+        self.load_controller: LoadController = None
 
     def print_frame(self) -> None:
         """
@@ -663,6 +830,9 @@ class Animation:
     def set_timing_plan(self, timing_plan: TimingPlan) -> None:
         self.timing_plan = timing_plan
 
+    def set_load_controller(self, load_controller: LoadController) -> None:
+        self.load_controller = load_controller
+
     def apply_timing_plan(self) -> None:
         """
         Function that orchestrates timed changes in animation.
@@ -699,9 +869,14 @@ class Animation:
         self.is_running = True
         self.timing_plan.set_timestamp_start(time.time())
         while self.is_running:
+            frame_start = time.perf_counter()
             self.print_frame()
             self.update_frame()
-            time.sleep(self.FRAME_SLEEP_PERIOD_SECONDS)
+            frame_time = time.perf_counter() - frame_start
+            if self.load_controller:
+                self.load_controller.register_frame_time(frame_time)
+            # Sleep for the rest of the frame period, so the drop speed doesn't depend on the frame computation time
+            time.sleep(max(self.FRAME_SLEEP_PERIOD_SECONDS - frame_time, 0))
             if self.timing_plan:
                 self.apply_timing_plan()
 
@@ -722,6 +897,7 @@ if __name__ == "__main__":
         total_run_time = 260 + 40
         )
     
+    calibrated_size = None
     while True:
         n_columns, n_rows = os.get_terminal_size()
         matrix = Matrix(n_rows, n_columns)
@@ -735,7 +911,17 @@ if __name__ == "__main__":
             message_texts = [message.strip() for message in messages_file.readlines()]
         matrix.set_message_texts(message_texts)
 
+        # Choose the highest fidelity level that fits the frame budget at the current terminal size
+        # With the same terminal size, the level that the load controller reached in the previous run is kept
+        if calibrated_size != (n_rows, n_columns):
+            calibration = Calibration(n_rows, n_columns, Animation.FRAME_SLEEP_PERIOD_SECONDS, ascii_image, message_texts)
+            load_controller = LoadController(matrix, Animation.FRAME_SLEEP_PERIOD_SECONDS, calibration.run())
+            calibrated_size = (n_rows, n_columns)
+        else:
+            load_controller.set_matrix(matrix)
+
         animation = Animation(matrix)
+        animation.set_load_controller(load_controller)
 
         timing_plan = TimingPlan(**timing)
         animation.set_timing_plan(timing_plan)
@@ -1,11 +1,31 @@
+import argparse
+import array
+import concurrent.futures
 import csv
-import plotly
+import io
+import json
+import math
+import os
 import re
+import sys
+from typing import Callable
+
+import numpy
 import requests
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "figure_export"))
+import chart_cache
+import figure_export
+
 # Data source
 google_sheets_doc_id = "1yRQxL9ZUJ9OTGiAhz7t7cAIk_GslfQkvWox16ivsqfQ"
-data_url = f"https://docs.google.com/spreadsheets/d/{google_sheets_doc_id}/export?format=csv"
+data_url_template = "https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv"
+data_url = data_url_template.format(doc_id=google_sheets_doc_id)
+
+# Multiple survey sheets are fetched concurrently and merged into one table, tagged by source
+source_field = "source"
+fetch_timeout_seconds = 30  # Connect / read timeout per source
+fetch_retries = 3  # Retries per source on connection errors and server errors
 
 # Settings
 plot_title = "Salaries of analysts"
@@ -16,6 +36,19 @@ y_axis_title = "Experience (years)"  # alternative: "Age (years)"
 label_field = "Ametikoht"
 colour_field = "Haridustase"
 
+filter_field = "Ametikoht"
+filter_regex_pattern = r"anal"  # alternatives: developers: r"aren"  all: r""
+
+x_outliers = 0.015  # Drop a fraction of top values for better visual
+sketch_relative_accuracy = 0.005  # Relative accuracy of the salary quantiles in incremental mode
+
+streaming_mode = False  # Filter and convert rows during download instead of parsing the whole sheet into a table
+stream_chunk_size = 2**16  # Bytes per downloaded chunk in streaming mode
+
+webgl_threshold = 20_000  # Number of points above which WebGL traces are used instead of SVG
+binning_threshold = 500_000  # Number of points above which points are aggregated into density bins per colour category
+n_density_bins = 100  # Number of density bins per axis
+
 colour_field_eng_reference = {
     "not specified": "not specified",
     "põhi": "middle school",
@@ -26,66 +59,772 @@ colour_field_eng_reference = {
     "mag": "masters",
     "dok": "doctorate"}
 
-# Download data
-response = requests.get(data_url)
-response.encoding = "utf8"
-reader = csv.DictReader(response.iter_lines(decode_unicode=True))
+# Colour fields with a regex reference of categories. Values of other colour fields are used as categories as is.
+colour_field_references = {
+    "Haridustase": {re.compile(key, re.IGNORECASE): value for key, value in colour_field_eng_reference.items()}}
 
-# Filter data
-filter_field = "Ametikoht"
-filter_regex_pattern = r"anal"  # alternatives: developers: r"aren"  all: r""
-filtered_records = [record for record in reader if re.search(filter_regex_pattern, record[filter_field], re.IGNORECASE)]
-
-# Extract and clean data
-x_data = [float(record[x_axis_field]) for record in filtered_records]
-y_data_nulls_removed = [record[y_axis_field] or 0 for record in filtered_records]
-y_data = [int(data_point) for data_point in y_data_nulls_removed]
-label_data = [record[label_field] for record in filtered_records]
-colour_field_map = {re.compile(key, re.IGNORECASE): value for key, value in colour_field_eng_reference.items()}
-colour_data_raw = [record[colour_field] or "not specified" for record in filtered_records]
-colour_data = [next(value for pattern, value in colour_field_map.items() if pattern.search(colour_data_point)) for colour_data_point in colour_data_raw]
-
-# Map colours to values with maximum scale stretch
-colour_scale_name = "RdBu"
-colour_scale = plotly.colors.PLOTLY_SCALES[colour_scale_name]
-existing_colours = [value for value in colour_field_eng_reference.values() if value in colour_data]
-colour_map_positions = {value: existing_colours.index(value) / (len(existing_colours) - 1) for value in existing_colours}
-colour_map = {key: colour_scale[int(value*(len(colour_scale)-1))][1] for key, value in colour_map_positions.items()}
-
-# Main scatter plot
-scatter_plot = plotly.graph_objects.Scatter(
-    x=x_data,
-    y=y_data,
-    mode="markers",
-    text=label_data,
-    hoverinfo="text",
-    marker=dict(color=[colour_map[data_point] for data_point in colour_data]),
-    showlegend=False)
-
-# Use separate scatter traces for each colour field category to get the colour legend
-# (plotly peculiarity)
-legend_traces = []
-for category, color in colour_map.items():
-    trace = plotly.graph_objects.Scatter(
-        x=[None], y=[None],  # Invisible markers
+
+class View:
+    """
+    Settings of a single chart variant. Unspecified settings default to the module level settings.
+    """
+    def __init__(
+            self,
+            name: str = None,
+            plot_title: str = plot_title,
+            filter_regex_pattern: str = filter_regex_pattern,
+            y_axis_field: str = y_axis_field,
+            y_axis_title: str = y_axis_title,
+            colour_field: str = colour_field) -> None:
+
+        self.plot_title: str = plot_title
+        self.filter_regex_pattern: str = filter_regex_pattern
+        self.y_axis_field: str = y_axis_field
+        self.y_axis_title: str = y_axis_title
+        self.colour_field: str = colour_field
+        self.name: str = name or self.get_default_name()
+
+    def get_default_name(self) -> str:
+        """
+        Returns a name (output file name) from the axis fields, role filter and colour field, so unnamed views that differ by them get different names.
+        """
+        name_parts = [x_axis_field, "vs", self.y_axis_field, self.filter_regex_pattern or "all", self.colour_field, "plot"]
+        return "_".join(re.sub(r"\W+", "_", part.lower()).strip("_") for part in name_parts)
+
+    def get_fields(self) -> list[str]:
+        """
+        Returns the data fields used by the view.
+        """
+        return list(dict.fromkeys([filter_field, x_axis_field, self.y_axis_field, label_field, self.colour_field]))
+
+
+###################
+# Data processing #
+###################
+
+def download_data(url: str) -> str:
+    """
+    Downloads the survey sheet as csv text.
+    """
+    response = requests.get(url)
+    response.encoding = "utf8"
+    return response.text
+
+
+def create_session(n_connections: int, n_retries: int = fetch_retries) -> requests.Session:
+    """
+    Returns a session with a pool of reusable connections that retries failed requests with backoff.
+    """
+    retry = requests.adapters.Retry(total=n_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=n_connections, pool_maxsize=n_connections, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_sources(urls: dict[str, str], timeout: float = fetch_timeout_seconds, n_retries: int = fetch_retries) -> dict[str, str]:
+    """
+    Downloads several survey sheets concurrently through a pooled session. Takes and returns dicts keyed by source tag.
+    Total download time approaches the time of the slowest source.
+    """
+    def download_source(url: str) -> str:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        response.encoding = "utf8"
+        return response.text
+
+    with create_session(len(urls), n_retries) as session:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            futures = {tag: executor.submit(download_source, url) for tag, url in urls.items()}
+            return {tag: future.result() for tag, future in futures.items()}
+
+
+def read_sources(csv_texts: dict[str, str], fields: list[str]) -> "pandas.DataFrame":
+    """
+    Parses the csv texts of several sources into one table. Rows are tagged by source in the source_field column.
+    """
+    import pandas
+    fields = [field for field in fields if field != source_field]
+    tables = [read_table(csv_text, fields).assign(**{source_field: tag}) for tag, csv_text in csv_texts.items()]
+    return pandas.concat(tables, ignore_index=True)
+
+
+def read_table(csv_text: str, fields: list[str], n_skip_rows: int = 0) -> "pandas.DataFrame":
+    """
+    Parses csv text into a table of the given fields, skipping the first n_skip_rows data rows.
+    All values are read as strings, empty cells as empty strings.
+    """
+    # pandas is imported only for table parsing, to keep the (streaming) stats mode startup fast
+    import pandas
+    skip_rows = (lambda i_row: 0 < i_row <= n_skip_rows) if n_skip_rows else None
+    return pandas.read_csv(io.StringIO(csv_text), usecols=fields, dtype=str, keep_default_na=False, skiprows=skip_rows)
+
+
+def map_unique(column: "pandas.Series", function: Callable, dtype: type = object) -> numpy.ndarray:
+    """
+    Applies function once per distinct value in column and broadcasts the results back to all rows.
+    Survey answers repeat a lot, so this keeps the per-row work vectorized.
+    """
+    import pandas
+    codes, unique_values = pandas.factorize(column)
+    unique_results = numpy.array([function(value) for value in unique_values], dtype=dtype)
+    return unique_results[codes]
+
+
+def get_filter_mask(column: "pandas.Series", regex_pattern: str) -> numpy.ndarray:
+    """
+    Returns a boolean mask of the column values that match the regex pattern (case insensitive).
+    """
+    filter_regex = re.compile(regex_pattern, re.IGNORECASE)
+    return map_unique(column, lambda value: filter_regex.search(value) is not None, dtype=bool)
+
+
+def filter_table(table: "pandas.DataFrame", field: str, regex_pattern: str) -> "pandas.DataFrame":
+    """
+    Keeps the rows where the field value matches the regex pattern (case insensitive).
+    """
+    return table[get_filter_mask(table[field], regex_pattern)]
+
+
+def get_colour_category(value: str, colour_field: str = colour_field) -> str:
+    """
+    Returns the english name of the first colour field category that matches the value.
+    Values of colour fields without a reference are returned as is.
+    """
+    if colour_field not in colour_field_references:
+        return value
+    return next(category for pattern, category in colour_field_references[colour_field].items() if pattern.search(value))
+
+
+def get_colour_data(table: "pandas.DataFrame", view: View) -> numpy.ndarray:
+    """
+    Maps the colour field values of the table to colour categories (nulls as "not specified").
+    """
+    colour_data_raw = table[view.colour_field].replace("", "not specified")
+    return map_unique(colour_data_raw, lambda value: get_colour_category(value, view.colour_field))
+
+
+def clean_data(table: "pandas.DataFrame", view: View) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    Extracts plot data from the filtered table: x values, y values (nulls as 0), labels and colour categories.
+    """
+    x_data = table[x_axis_field].astype(float).to_numpy()
+    y_data = table[view.y_axis_field].replace("", "0").astype(int).to_numpy()
+    label_data = table[label_field].to_numpy()
+    colour_data = get_colour_data(table, view)
+    return x_data, y_data, label_data, colour_data
+
+
+def stream_data(url: str, view: View, chunk_size: int = stream_chunk_size) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    Downloads and decodes the survey sheet in chunks, filtering and converting rows on the fly.
+    Only the plot fields of matching rows are kept: x values in array('d'), y values in array('i')
+    and labels / colour categories as array('i') codes into lists of distinct values.
+    Memory use doesn't depend on the number of rows in the sheet, only on the number of matching rows.
+    """
+    filter_regex = re.compile(view.filter_regex_pattern, re.IGNORECASE)
+
+    x_data = array.array("d")
+    y_data = array.array("i")
+    label_codes = array.array("i")
+    colour_codes = array.array("i")
+
+    # Regex results and distinct values are cached, because survey answers repeat a lot
+    filter_results: dict[str, bool] = {}
+    label_values: dict[str, int] = {}
+    colour_results: dict[str, int] = {}
+    colour_categories: dict[str, int] = {}
+
+    with requests.get(url, stream=True) as response:
+        response.encoding = "utf8"
+        reader = csv.reader(response.iter_lines(chunk_size=chunk_size, decode_unicode=True))
+        header = next(reader)
+        i_filter, i_x, i_y, i_label, i_colour = (header.index(field) for field in (filter_field, x_axis_field, view.y_axis_field, label_field, view.colour_field))
+
+        for row in reader:
+            # Skip blank lines (like csv.DictReader), e.g. when a chunk boundary splits a line break
+            if not row:
+                continue
+            filter_value = row[i_filter]
+            if (is_match := filter_results.get(filter_value)) is None:
+                is_match = filter_results[filter_value] = filter_regex.search(filter_value) is not None
+            if not is_match:
+                continue
+
+            x_data.append(float(row[i_x]))
+            y_data.append(int(row[i_y] or 0))
+            label_codes.append(label_values.setdefault(row[i_label], len(label_values)))
+            colour_value = row[i_colour] or "not specified"
+            if (colour_code := colour_results.get(colour_value)) is None:
+                colour_category = get_colour_category(colour_value, view.colour_field)
+                colour_code = colour_results[colour_value] = colour_categories.setdefault(colour_category, len(colour_categories))
+            colour_codes.append(colour_code)
+
+    # Zero-copy views of the typed arrays, code arrays are expanded to (shared) string references
+    label_data = numpy.array(list(label_values), dtype=object)[numpy.frombuffer(label_codes, dtype=numpy.intc)]
+    colour_data = numpy.array(list(colour_categories), dtype=object)[numpy.frombuffer(colour_codes, dtype=numpy.intc)]
+    return numpy.frombuffer(x_data, dtype=float), numpy.frombuffer(y_data, dtype=numpy.intc), label_data, colour_data
+
+
+##############
+# Statistics #
+##############
+
+def get_outlier_cap(x_data: numpy.ndarray) -> float:
+    """
+    Returns the x value above which a fraction (x_outliers) of top values is dropped for better visual.
+    """
+    i_cap = int(len(x_data) * (1 - x_outliers))
+    return numpy.partition(x_data, i_cap)[i_cap]
+
+
+def get_summary(x_data: numpy.ndarray, y_data: numpy.ndarray, colour_data: numpy.ndarray, view: View) -> dict:
+    """
+    Returns summary statistics of the filtered data: record count, salary distribution, outlier cap and per colour category salaries.
+    Statistics of a filter without matching rows are None (like in SummaryState.get_summary).
+    """
+    if not len(x_data):
+        return {
+            "filter_regex_pattern": view.filter_regex_pattern,
+            "n_records": 0,
+            x_axis_field: dict.fromkeys(["mean", "median", "min", "max", "outlier_cap"]),
+            view.y_axis_field: dict.fromkeys(["mean", "median"]),
+            view.colour_field: {}}
+
+    categories = {}
+    for category in dict.fromkeys(colour_data):
+        category_x_data = x_data[colour_data == category]
+        categories[category] = dict(
+            n_records=len(category_x_data),
+            mean=float(category_x_data.mean()),
+            median=float(numpy.median(category_x_data)))
+
+    return {
+        "filter_regex_pattern": view.filter_regex_pattern,
+        "n_records": len(x_data),
+        x_axis_field: dict(
+            mean=float(x_data.mean()),
+            median=float(numpy.median(x_data)),
+            min=float(x_data.min()),
+            max=float(x_data.max()),
+            outlier_cap=float(get_outlier_cap(x_data))),
+        view.y_axis_field: dict(
+            mean=float(y_data.mean()),
+            median=float(numpy.median(y_data))),
+        view.colour_field: categories}
+
+
+def print_summary(summary: dict, indent: str = "") -> None:
+    """
+    Prints a (nested) summary as indented key: value lines.
+    """
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            print(f"{indent}{key}:")
+            print_summary(value, indent + "  ")
+            continue
+        print(f"{indent}{key}: {round(value, 2) if isinstance(value, float) else value}")
+
+
+##########################
+# Incremental statistics #
+##########################
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with bounded relative error.
+    Positive values are counted in logarithmically sized buckets, so any quantile is accurate within relative_accuracy.
+    """
+    def __init__(self, relative_accuracy: float = sketch_relative_accuracy) -> None:
+        self.relative_accuracy: float = relative_accuracy
+        self.gamma: float = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma: float = math.log(self.gamma)
+        self.buckets: dict[int, int] = {}       # Bucket index: count. Bucket i holds values in (gamma^(i-1), gamma^i]
+        self.n_non_positive: int = 0            # Count of values <= 0 (e.g. missing salaries)
+        self.count: int = 0
+
+    def add(self, values: numpy.ndarray) -> None:
+        """
+        Folds values into the sketch.
+        """
+        is_positive = values > 0
+        keys, counts = numpy.unique(numpy.ceil(numpy.log(values[is_positive]) / self.log_gamma).astype(int), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.n_non_positive += int((~is_positive).sum())
+        self.count += len(values)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """
+        Folds the counts of another sketch into this one.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged.")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.n_non_positive += other.n_non_positive
+        self.count += other.count
+
+    def get_quantile(self, quantile: float) -> float:
+        """
+        Returns the approximate value at quantile (0...1).
+        """
+        if not self.count:
+            return math.nan
+        rank = quantile * (self.count - 1)
+        cumulative_count = self.n_non_positive
+        if cumulative_count > rank:
+            return 0.0
+        for key in sorted(self.buckets):
+            cumulative_count += self.buckets[key]
+            if cumulative_count > rank:
+                # Bucket midpoint with equal relative distance to both bucket edges
+                return 2 * self.gamma**key / (self.gamma + 1)
+        return 2 * self.gamma**max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return dict(relative_accuracy=self.relative_accuracy, buckets=self.buckets, n_non_positive=self.n_non_positive, count=self.count)
+
+    @staticmethod
+    def from_dict(values: dict) -> "QuantileSketch":
+        sketch = QuantileSketch(values["relative_accuracy"])
+        sketch.buckets = {int(key): count for key, count in values["buckets"].items()}
+        sketch.n_non_positive = values["n_non_positive"]
+        sketch.count = values["count"]
+        return sketch
+
+
+class CategorySummary:
+    """
+    Mergeable summary of x and y values of a category: count, sums, ranges and a quantile sketch of x values.
+    """
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.x_sum: float = 0.0
+        self.x_min: float = math.inf
+        self.x_max: float = -math.inf
+        self.y_sum: float = 0.0
+        self.y_min: float = math.inf
+        self.y_max: float = -math.inf
+        self.x_sketch: QuantileSketch = QuantileSketch()
+
+    def add(self, x_data: numpy.ndarray, y_data: numpy.ndarray) -> None:
+        if not len(x_data):
+            return
+        self.count += len(x_data)
+        self.x_sum += float(x_data.sum())
+        self.x_min = min(self.x_min, float(x_data.min()))
+        self.x_max = max(self.x_max, float(x_data.max()))
+        self.y_sum += float(y_data.sum())
+        self.y_min = min(self.y_min, float(y_data.min()))
+        self.y_max = max(self.y_max, float(y_data.max()))
+        self.x_sketch.add(x_data)
+
+    def merge(self, other: "CategorySummary") -> None:
+        self.count += other.count
+        self.x_sum += other.x_sum
+        self.x_min = min(self.x_min, other.x_min)
+        self.x_max = max(self.x_max, other.x_max)
+        self.y_sum += other.y_sum
+        self.y_min = min(self.y_min, other.y_min)
+        self.y_max = max(self.y_max, other.y_max)
+        self.x_sketch.merge(other.x_sketch)
+
+    def to_dict(self) -> dict:
+        values = {key: value for key, value in vars(self).items() if key != "x_sketch"}
+        return values | dict(x_sketch=self.x_sketch.to_dict())
+
+    @staticmethod
+    def from_dict(values: dict) -> "CategorySummary":
+        summary = CategorySummary()
+        for key, value in values.items():
+            setattr(summary, key, value)
+        summary.x_sketch = QuantileSketch.from_dict(values["x_sketch"])
+        return summary
+
+
+class SummaryState:
+    """
+    Persistent incremental summary of the survey: a CategorySummary per role filter and colour category.
+    Keeps count of the rows that have been folded in, so only newly appended rows are processed on update.
+    """
+    def __init__(self, filter_regex_patterns: list[str], view: View) -> None:
+        self.filter_regex_patterns: list[str] = filter_regex_patterns
+        self.view: View = view
+        self.n_rows_processed: int = 0
+        self.summaries: dict[str, dict[str, CategorySummary]] = {pattern: {} for pattern in filter_regex_patterns}
+
+    def update(self, csv_text: str) -> int:
+        """
+        Folds the rows that have been appended since the last update into the summaries. Returns the number of new rows.
+        """
+        new_rows = read_table(csv_text, self.view.get_fields(), n_skip_rows=self.n_rows_processed)
+        for pattern in self.filter_regex_patterns:
+            x_data, y_data, _, colour_data = clean_data(filter_table(new_rows, filter_field, pattern), self.view)
+            for category in dict.fromkeys(colour_data):
+                is_category = colour_data == category
+                self.summaries[pattern].setdefault(category, CategorySummary()).add(x_data[is_category], y_data[is_category])
+        self.n_rows_processed += len(new_rows)
+        return len(new_rows)
+
+    def get_summary(self, filter_regex_pattern: str) -> dict:
+        """
+        Returns the summary of a role filter: counts and means per category, overall outlier cap and axis ranges from the merged sketches.
+        Statistics of a filter without matching rows are None (not NaN / infinity, which aren't valid json).
+        """
+        total = CategorySummary()
+        for category_summary in self.summaries[filter_regex_pattern].values():
+            total.merge(category_summary)
+
+        if not total.count:
+            return {
+                "filter_regex_pattern": filter_regex_pattern,
+                "n_records": 0,
+                x_axis_field: dict.fromkeys(["mean", "median", "min", "max", "outlier_cap", "axis_range"]),
+                self.view.y_axis_field: dict.fromkeys(["mean", "axis_range"]),
+                self.view.colour_field: {}}
+
+        x_cap = total.x_sketch.get_quantile(1 - x_outliers)
+
+        categories = {
+            category: dict(
+                n_records=category_summary.count,
+                mean=category_summary.x_sum / category_summary.count,
+                median=category_summary.x_sketch.get_quantile(0.5))
+            for category, category_summary in self.summaries[filter_regex_pattern].items()}
+
+        return {
+            "filter_regex_pattern": filter_regex_pattern,
+            "n_records": total.count,
+            x_axis_field: dict(
+                mean=total.x_sum / total.count,
+                median=total.x_sketch.get_quantile(0.5),
+                min=total.x_min,
+                max=total.x_max,
+                outlier_cap=x_cap,
+                axis_range=[total.x_min - 100, x_cap + 100]),
+            self.view.y_axis_field: dict(
+                mean=total.y_sum / total.count,
+                axis_range=[total.y_min, total.y_max]),
+            self.view.colour_field: categories}
+
+    def save(self, path: str) -> None:
+        state = dict(
+            filter_regex_patterns=self.filter_regex_patterns,
+            view=vars(self.view),
+            n_rows_processed=self.n_rows_processed,
+            summaries={pattern: {category: summary.to_dict() for category, summary in category_summaries.items()} for pattern, category_summaries in self.summaries.items()})
+        # Write to a temporary file first, so an interrupted save doesn't corrupt the state
+        with open(f"{path}.tmp", "w") as state_file:
+            json.dump(state, state_file, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def load(path: str) -> "SummaryState":
+        with open(path) as state_file:
+            state = json.load(state_file)
+        summary_state = SummaryState(state["filter_regex_patterns"], View(**state["view"]))
+        summary_state.n_rows_processed = state["n_rows_processed"]
+        summary_state.summaries = {
+            pattern: {category: CategorySummary.from_dict(summary) for category, summary in category_summaries.items()}
+            for pattern, category_summaries in state["summaries"].items()}
+        return summary_state
+
+
+############
+# Plotting #
+############
+
+def get_colour_map(colour_data: numpy.ndarray, colour_field: str = colour_field, colour_scale_name: str = "RdBu") -> dict[str, str]:
+    """
+    Maps the colour categories present in data to colours with maximum scale stretch.
+    """
+    import plotly.colors
+    colour_scale = plotly.colors.PLOTLY_SCALES[colour_scale_name]
+    present_colours = set(colour_data)
+    if colour_field in colour_field_references:
+        existing_colours = [value for value in colour_field_references[colour_field].values() if value in present_colours]
+    else:
+        existing_colours = sorted(present_colours)
+    if len(existing_colours) == 1:
+        # A single category (e.g. a single source) is placed in the middle of the scale
+        colour_map_positions = {existing_colours[0]: 0.5}
+    else:
+        colour_map_positions = {value: existing_colours.index(value) / (len(existing_colours) - 1) for value in existing_colours}
+    return {key: colour_scale[int(value*(len(colour_scale)-1))][1] for key, value in colour_map_positions.items()}
+
+
+def get_scatter_traces(x_data: numpy.ndarray, y_data: numpy.ndarray, label_data: numpy.ndarray, colour_data: numpy.ndarray, colour_map: dict[str, str]) -> list:
+    """
+    Returns an SVG scatter trace of all points with hover labels and invisible legend traces.
+    """
+    import pandas
+    import plotly.graph_objects
+    # Main scatter plot
+    scatter_plot = plotly.graph_objects.Scatter(
+        x=x_data,
+        y=y_data,
         mode="markers",
-        marker=dict(color=color),
-        name=category)
-    legend_traces.append(trace)
-
-# Drop a fraction of top values for better visual
-x_outliers = 0.015
-x_cap = sorted(x_data)[int(len(x_data) * (1 - x_outliers))]
-
-# Add plot labels and legend
-figure = plotly.graph_objects.Figure(data=[scatter_plot] + legend_traces)
-figure.update_layout(
-    title=plot_title,
-    xaxis=dict(
-        title = x_axis_title,
-        range = [min(x_data) - 100, x_cap + 100]),
-    yaxis_title=y_axis_title)
-
-# Show / save
-figure.show()
-# figure.write_image(f"{x_axis_field.lower().replace(' ', '_')}_vs_{y_axis_field.lower().replace(' ', '_')}_plot.png")
+        text=label_data,
+        hoverinfo="text",
+        marker=dict(color=pandas.Series(colour_data).map(colour_map).to_numpy()),
+        showlegend=False)
+
+    # Use separate scatter traces for each colour field category to get the colour legend
+    # (plotly peculiarity)
+    legend_traces = []
+    for category, color in colour_map.items():
+        trace = plotly.graph_objects.Scatter(
+            x=[None], y=[None],  # Invisible markers
+            mode="markers",
+            marker=dict(color=color),
+            name=category)
+        legend_traces.append(trace)
+
+    return [scatter_plot] + legend_traces
+
+
+def get_webgl_traces(x_data: numpy.ndarray, y_data: numpy.ndarray, colour_data: numpy.ndarray, colour_map: dict[str, str]) -> list:
+    """
+    Returns one WebGL scatter trace per colour category. Per-point hover labels are left out to keep the figure small.
+    """
+    import plotly.graph_objects
+    traces = []
+    for category, color in colour_map.items():
+        is_category = colour_data == category
+        trace = plotly.graph_objects.Scattergl(
+            x=x_data[is_category],
+            y=y_data[is_category],
+            mode="markers",
+            hoverinfo="x+y+name",
+            marker=dict(color=color, size=3),
+            name=category)
+        traces.append(trace)
+    return traces
+
+
+def get_binned_traces(x_data: numpy.ndarray, y_data: numpy.ndarray, colour_data: numpy.ndarray, colour_map: dict[str, str], x_range: tuple[float, float]) -> list:
+    """
+    Aggregates points into 2D density bins per colour category and returns a trace per category
+    with a marker in the centre of every non-empty bin, sized by the number of points in the bin.
+    The number of plotted markers doesn't depend on the number of data points.
+    """
+    import plotly.graph_objects
+    # Same bin edges for all categories, so the markers of different categories line up
+    # y values are integers: the edges are offset by half a year, so unit-width bins are centred on the values
+    x_edges = numpy.linspace(*x_range, n_density_bins + 1)
+    y_edges = numpy.linspace(y_data.min() - 0.5, y_data.max() + 0.5, min(n_density_bins, int(y_data.max() - y_data.min()) + 1) + 1)
+    x_centres = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centres = (y_edges[:-1] + y_edges[1:]) / 2
+
+    category_counts = {
+        category: numpy.histogram2d(x_data[colour_data == category], y_data[colour_data == category], bins=[x_edges, y_edges])[0]
+        for category in colour_map}
+    # One marker size scale for all categories, so the bin sizes are comparable between categories
+    max_count = max((counts.max() for counts in category_counts.values()), default=1)
+
+    traces = []
+    for category, color in colour_map.items():
+        counts = category_counts[category]
+        i_x, i_y = numpy.nonzero(counts)
+        bin_counts = counts[i_x, i_y]
+        trace = plotly.graph_objects.Scatter(
+            x=x_centres[i_x],
+            y=y_centres[i_y],
+            mode="markers",
+            text=[f"{category}: {int(count)}" for count in bin_counts],
+            hoverinfo="text",
+            marker=dict(color=color, size=bin_counts, sizemode="area", sizeref=2 * max(max_count, 1) / 20**2, opacity=0.6),  # Largest bin of all categories is 20 px
+            name=category)
+        traces.append(trace)
+    return traces
+
+
+def build_figure(x_data: numpy.ndarray, y_data: numpy.ndarray, label_data: numpy.ndarray, colour_data: numpy.ndarray, view: View) -> "plotly.graph_objects.Figure":
+    """
+    Builds the salary scatter plot with a colour legend of the colour field categories.
+    Large datasets are drawn with WebGL traces or aggregated into density bins (see webgl_threshold and binning_threshold).
+    """
+    import plotly.graph_objects
+
+    colour_map = get_colour_map(colour_data, view.colour_field)
+
+    x_cap = get_outlier_cap(x_data)
+    x_min = x_data.min()
+
+    if len(x_data) > binning_threshold:
+        traces = get_binned_traces(x_data, y_data, colour_data, colour_map, x_range=(x_min, x_cap))
+    elif len(x_data) > webgl_threshold:
+        traces = get_webgl_traces(x_data, y_data, colour_data, colour_map)
+    else:
+        traces = get_scatter_traces(x_data, y_data, label_data, colour_data, colour_map)
+
+    # Add plot labels and legend
+    figure = plotly.graph_objects.Figure(data=traces)
+    figure.update_layout(
+        title=view.plot_title,
+        xaxis=dict(
+            title = x_axis_title,
+            range = [x_min - 100, x_cap + 100]),
+        yaxis_title=view.y_axis_title)
+    return figure
+
+
+##############
+# Batch mode #
+##############
+
+def build_view_output(x_data: numpy.ndarray, y_data: numpy.ndarray, label_data: numpy.ndarray, colour_data: numpy.ndarray, view: View, output_format: str) -> bytes | str:
+    """
+    Builds the figure of a view. Returns html bytes, or the figure json for image formats (rendered by the export pool).
+    """
+    figure = build_figure(x_data, y_data, label_data, colour_data, view)
+    if output_format == "html":
+        return figure.to_html().encode("utf8")
+    return figure.to_json()
+
+
+def get_view_cache_key(plot_data: tuple, view: View, output_format: str, script_hash: str) -> str:
+    """
+    Returns the chart cache key of a view: a hash of the plot data, view and plot settings and this script.
+    """
+    view_settings = {key: value for key, value in vars(view).items() if key != "name"}
+    plot_settings = dict(
+        x_axis_title=x_axis_title,
+        x_outliers=x_outliers,
+        webgl_threshold=webgl_threshold,
+        binning_threshold=binning_threshold,
+        n_density_bins=n_density_bins)
+    return chart_cache.ChartCache.get_key(
+        data=plot_data,
+        spec=dict(view=view_settings, plot=plot_settings, output_format=output_format, script=script_hash))
+
+
+def run_batch(views: list[View], output_dir: str, output_format: str = "html", n_workers: int = None) -> list[str]:
+    """
+    Downloads and parses the data once and writes a figure for every view.
+    Filter masks are computed once per distinct regex pattern and shared by the views.
+    Figures are built in parallel worker processes, unless an identical chart is already in the chart cache.
+    Images are rendered by a pool of warm export engines, so N images cost one engine startup per worker plus N renders.
+    """
+    if output_format != "html" and output_format not in figure_export.IMAGE_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}. Available formats: html, {', '.join(figure_export.IMAGE_FORMATS)}")
+    # Views with the same name would write the same output file
+    duplicate_names = sorted({view.name for view in views if [other.name for other in views].count(view.name) > 1})
+    if duplicate_names:
+        raise ValueError(f"Views have duplicate names: {', '.join(duplicate_names)}. Set a unique name for each view.")
+
+    fields = list(dict.fromkeys(field for view in views for field in view.get_fields()))
+    table = read_table(download_data(data_url), fields)
+
+    filter_masks = {pattern: get_filter_mask(table[filter_field], pattern) for pattern in {view.filter_regex_pattern for view in views}}
+
+    cache = chart_cache.ChartCache()
+    script_hash = chart_cache.get_file_hash(__file__)
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = []
+    # Export workers (and their engines) are only started when the first image is submitted, i.e. not if all charts are cached
+    export_pool = figure_export.ExportPool(n_workers) if output_format != "html" else None
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {}
+            for view in views:
+                plot_data = clean_data(table[filter_masks[view.filter_regex_pattern]], view)
+                output_path = os.path.join(output_dir, f"{view.name}.{output_format}")
+                output_paths.append(output_path)
+                cache_key = get_view_cache_key(plot_data, view, output_format, script_hash)
+                if (content := cache.get(cache_key, output_format)) is None:
+                    futures[output_path] = (cache_key, executor.submit(build_view_output, *plot_data, view, output_format))
+                    continue
+                with open(output_path, "wb") as output_file:
+                    output_file.write(content)
+
+            # Built figures are sent to the export pool in order, while the remaining figures are still being built
+            if export_pool:
+                futures = {output_path: (cache_key, export_pool.submit(future.result(), output_format)) for output_path, (cache_key, future) in futures.items()}
+
+            for output_path, (cache_key, future) in futures.items():
+                content = future.result()
+                cache.put(cache_key, output_format, content)
+                with open(output_path, "wb") as output_file:
+                    output_file.write(content)
+    finally:
+        if export_pool:
+            export_pool.close()
+
+    return output_paths
+
+
+#######
+# Run #
+#######
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Plot salary survey data.")
+    argument_parser.add_argument("--views", help="Path to a json file with a list of view specs (View arguments) to write in batch mode")
+    argument_parser.add_argument("--output-dir", default="plots", help="Batch mode output directory")
+    argument_parser.add_argument("--format", default="html", help="Batch mode output format: html, png, svg, ...")
+    argument_parser.add_argument("--workers", type=int, help="Number of parallel workers in batch mode")
+    argument_parser.add_argument("--stats", action="store_true", help="Print summary statistics instead of plotting")
+    argument_parser.add_argument("--json", action="store_true", help="Print summary statistics as json (implies --stats)")
+    argument_parser.add_argument("--incremental", metavar="STATE_PATH", help="Fold newly appended rows into the summary state file and print the summaries")
+    argument_parser.add_argument("--sources", nargs="+", metavar="TAG=DOC_ID", help="Google sheets documents to fetch concurrently and plot together, coloured by source")
+    argument_parser.add_argument("--filters", nargs="+", default=[filter_regex_pattern], help="Role filter regex patterns of the incremental summary state")
+    arguments = argument_parser.parse_args()
+
+    if arguments.incremental:
+        if os.path.exists(arguments.incremental):
+            summary_state = SummaryState.load(arguments.incremental)
+            if summary_state.filter_regex_patterns != arguments.filters:
+                raise ValueError(f"Summary state {arguments.incremental} has role filters {summary_state.filter_regex_patterns}. Use a new state file for other filters.")
+        else:
+            summary_state = SummaryState(arguments.filters, View())
+        summary_state.update(download_data(data_url))
+        summary_state.save(arguments.incremental)
+
+        summaries = [summary_state.get_summary(pattern) for pattern in summary_state.filter_regex_patterns]
+        if arguments.json:
+            print(json.dumps(summaries, indent=2, ensure_ascii=False))
+        else:
+            for summary in summaries:
+                print_summary(summary)
+
+    elif arguments.views:
+        with open(arguments.views) as views_file:
+            views = [View(**view_spec) for view_spec in json.load(views_file)]
+        for output_path in run_batch(views, arguments.output_dir, arguments.format, arguments.workers):
+            print(output_path)
+
+    else:
+        view = View()
+        if arguments.sources:
+            view = View(colour_field=source_field)
+            doc_ids = dict(source.split("=", 1) if "=" in source else (source, source) for source in arguments.sources)
+            csv_texts = download_sources({tag: data_url_template.format(doc_id=doc_id) for tag, doc_id in doc_ids.items()})
+            table = read_sources(csv_texts, view.get_fields())
+            filtered_table = filter_table(table, filter_field, view.filter_regex_pattern)
+            x_data, y_data, label_data, colour_data = clean_data(filtered_table, view)
+        elif streaming_mode or arguments.stats or arguments.json:
+            # Stats mode always streams: the csv + numpy path doesn't import pandas, so it starts faster
+            x_data, y_data, label_data, colour_data = stream_data(data_url, view)
+        else:
+            table = read_table(download_data(data_url), view.get_fields())
+            filtered_table = filter_table(table, filter_field, view.filter_regex_pattern)
+            x_data, y_data, label_data, colour_data = clean_data(filtered_table, view)
+
+        # Stats mode doesn't import plotting libraries (or pandas, unless several sources are merged)
+        if arguments.stats or arguments.json:
+            summary = get_summary(x_data, y_data, colour_data, view)
+            if arguments.json:
+                print(json.dumps(summary, indent=2, ensure_ascii=False))
+            else:
+                print_summary(summary)
+
+        else:
+            figure = build_figure(x_data, y_data, label_data, colour_data, view)
+
+            # Show / save
+            figure.show()
+            # figure_export.write_figure(figure, f"{view.name}.png")